@@ -28,43 +28,40 @@ Email:  ljnath@ljnath.com
 Website: https://ljnath.com
 
 """
-import mimetypes
 from abc import ABC, abstractmethod
+from dataclasses import dataclass
+from typing import Any, Callable
 import argparse
+from functools import lru_cache
+from concurrent.futures import Future, ThreadPoolExecutor
 from pathlib import Path
 import logging
 from logging.handlers import RotatingFileHandler
+import hashlib
 import re
+import shutil
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import boto3
+from boto3.exceptions import S3UploadFailedError
+from boto3.s3.transfer import TransferConfig
+from botocore.compat import HAS_CRT
+from botocore.config import Config as BotoConfig
+from botocore.exceptions import BotoCoreError, ClientError, HTTPClientError
+from botocore.exceptions import ConnectionError as BotoConnectionError
 import os
+import queue
 import time
 from dotenv import load_dotenv
+import google_auth_httplib2
+import httplib2
 from google.oauth2.service_account import Credentials
 from googleapiclient.discovery import build
-from googleapiclient.http import MediaFileUpload
+from googleapiclient.errors import HttpError
+from googleapiclient.http import HttpRequest, MediaIoBaseUpload
 
 
-"""
-LOADING USER CONFIG FROM .ENV file
-"""
-load_dotenv()
-
-CPANEL_URL = os.getenv("CPANEL_URL")
-CPANEL_USERNAME = os.getenv("CPANEL_USERNAME")
-CPANEL_API_TOKEN = os.getenv("CPANEL_API_TOKEN")
-
-AWS_PROFILE = os.getenv("AWS_PROFILE_NAME")
-S3_BUCKET_NAME = os.getenv("S3_BUCKET_NAME")
-S3_BACKUP_KEY_PREFIX = os.getenv("S3_BACKUP_KEY_PREFIX")
-
-MAX_BACKUP_FILES = int(os.getenv("MAX_BACKUP_FILES"))
-BACKUP_CHECK_DELAY = int(os.getenv("BACKUP_CHECK_DELAY"))
-BACKUP_DESTINATION_EMAIL = os.getenv("BACKUP_EMAIL")
-
-GOOGLE_CREDENTIALS_FILE = os.getenv("GOOGLE_CREDENTIALS_FILE")
-GOOGLE_DRIVE_FOLDER_ID = os.getenv("GOOGLE_DRIVE_FOLDER_ID")
-
 APP_NAME = 'cPanelBackupPlus'
 APP_VERSION = '1.0'
 LOGS_DIRECTORY = 'logs'
@@ -100,11 +97,91 @@ class LogHandler():
         return logger
 
 
+@dataclass(frozen=True, slots=True)
+class Config():
+    """ User config loaded from the .env file
+    """
+    cpanel_url: str
+    cpanel_username: str
+    cpanel_api_token: str
+
+    aws_profile: str
+    s3_bucket_name: str
+    s3_backup_key_prefix: str
+
+    max_backup_files: int
+    backup_check_delay: int
+    backup_destination_email: str
+
+    google_credentials_file: str
+    google_drive_folder_id: str
+
+
+def load_config() -> Config:
+    """ Loads the user config from the .env file
+    """
+    load_dotenv()
+
+    return Config(
+        cpanel_url=os.getenv("CPANEL_URL"),
+        cpanel_username=os.getenv("CPANEL_USERNAME"),
+        cpanel_api_token=os.getenv("CPANEL_API_TOKEN"),
+        aws_profile=os.getenv("AWS_PROFILE_NAME"),
+        s3_bucket_name=os.getenv("S3_BUCKET_NAME"),
+        s3_backup_key_prefix=os.getenv("S3_BACKUP_KEY_PREFIX"),
+        max_backup_files=int(os.getenv("MAX_BACKUP_FILES")),
+        backup_check_delay=int(os.getenv("BACKUP_CHECK_DELAY")),
+        backup_destination_email=os.getenv("BACKUP_EMAIL"),
+        google_credentials_file=os.getenv("GOOGLE_CREDENTIALS_FILE"),
+        google_drive_folder_id=os.getenv("GOOGLE_DRIVE_FOLDER_ID")
+    )
+
+
+@lru_cache(maxsize=None)
+def get_s3_client(aws_profile: str) -> Any:
+    """ Returns the S3 client shared by all S3Handler instances and threads, boto3 clients are thread-safe.
+        Connection pool is sized above the multipart upload concurrency to avoid pool exhaustion
+    """
+    session = boto3.Session(profile_name=aws_profile)
+    return session.client('s3', config=BotoConfig(max_pool_connections=32, retries={'max_attempts': 10, 'mode': 'adaptive'}))
+
+
+def retry_with_backoff(fn: Callable[[], Any], retryable: tuple, logger: logging.Logger, attempts: int = 3, base: int = 2, is_transient: Callable[[Exception], bool] = None) -> Any:
+    """ Calls fn and retries it with exponential backoff when any of the retryable exceptions is raised,
+        is_transient can further filter the raised exception ; non-transient exceptions are raised immediately
+    """
+    for attempt in range(attempts):
+        try:
+            return fn()
+        except retryable as e:
+            if attempt == attempts - 1 or (is_transient and not is_transient(e)):
+                raise
+
+            delay = base ** attempt
+            logger.warning(f'Attempt {attempt + 1} of {attempts} failed, retrying in {delay} seconds, Error: {str(e)}')
+            time.sleep(delay)
+
+
+def compute_sha256(filepath: str) -> str:
+    """ Computes the SHA-256 hex digest of a file by reading it sequentially in 8 MB blocks
+    """
+    digest = hashlib.sha256()
+    with open(filepath, 'rb') as file:
+        while block := file.read(8 * 1024 * 1024):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+
 class CloudStorageHandler(ABC):
     """Abstract class for all cloud storage handler
     """
     @abstractmethod
-    def upload(self, filepath: str) -> bool:
+    def upload(self, filepath: str, digest: str = None) -> bool:
+        pass
+
+    @abstractmethod
+    def get_latest_digest(self) -> str:
         pass
 
     @abstractmethod
@@ -116,31 +193,56 @@ class S3Handler(CloudStorageHandler):
     """ Child class of CloudStorageHandler to handle S3 operations
     """
 
-    def __init__(self) -> None:
+    def __init__(self, cfg: Config) -> None:
         self.logger = LogHandler().get_logger(name=__class__.__name__)
+        self.cfg = cfg
 
-        session = boto3.Session(profile_name=AWS_PROFILE)
-        self.s3_client = session.client('s3')
+        self.s3_client = get_s3_client(cfg.aws_profile)
 
-    def purge(self) -> None:
-        # get current files in the bucket
-        response = self.s3_client.list_objects_v2(Bucket=S3_BUCKET_NAME, Prefix=S3_BACKUP_KEY_PREFIX)
+        # multipart transfer config, parts are uploaded in parallel by multiple threads
+        self._tc = TransferConfig(multipart_threshold=8 * 1024 * 1024, multipart_chunksize=16 * 1024 * 1024, max_concurrency=10, use_threads=True)
+
+        # CRC32C integrity checksum replaces the per-part MD5 ; botocore needs awscrt for CRC32C, otherwise falling back to zlib based CRC32
+        self._extra_args = {'ChecksumAlgorithm': 'CRC32C' if HAS_CRT else 'CRC32'}
+
+    def __list_backup_files(self) -> list:
+        # get current files in the bucket, paginating as a single listing returns at most 1000 keys
+        paginator = self.s3_client.get_paginator('list_objects_v2')
+        files = [file for page in paginator.paginate(Bucket=self.cfg.s3_bucket_name, Prefix=self.cfg.s3_backup_key_prefix) for file in page.get('Contents', [])]
 
-        if 'Contents' in response:
-            files = response['Contents']
+        # Sort files by last modified date
+        return sorted(files, key=lambda x: x['LastModified'])
 
-            # Sort files by last modified date
-            existing_files = sorted(files, key=lambda x: x['LastModified'])
+    def get_latest_digest(self) -> str:
+        existing_files = self.__list_backup_files()
+        if not existing_files:
+            return None
 
-            # If there are more than max_backup_files, delete the oldest ones
-            if len(existing_files) > MAX_BACKUP_FILES:
-                files_to_delete = existing_files[:len(existing_files) - MAX_BACKUP_FILES]
-                for file in files_to_delete:
-                    file_key = file['Key']
-                    self.s3_client.delete_object(Bucket=S3_BUCKET_NAME, Key=file_key)
-                    self.logger.info(f"Successfully purged old backup file from S3, s3://{S3_BUCKET_NAME}/{file_key}")
+        # SHA-256 digest is stored as object metadata during upload
+        response = self.s3_client.head_object(Bucket=self.cfg.s3_bucket_name, Key=existing_files[-1]['Key'])
+        return response.get('Metadata', {}).get('sha256')
 
-    def upload(self, filepath: str) -> bool:
+    def purge(self) -> None:
+        existing_files = self.__list_backup_files()
+
+        # If there are more than max_backup_files, delete the oldest ones
+        if len(existing_files) > self.cfg.max_backup_files:
+            files_to_delete = existing_files[:len(existing_files) - self.cfg.max_backup_files]
+
+            # delete_objects accepts at most 1000 keys per request
+            for i in range(0, len(files_to_delete), 1000):
+                batch = files_to_delete[i:i + 1000]
+                response = self.s3_client.delete_objects(Bucket=self.cfg.s3_bucket_name, Delete={'Objects': [{'Key': file['Key']} for file in batch], 'Quiet': True})
+
+                # in quiet mode only the failed deletions are returned
+                failed_keys = {error['Key'] for error in response.get('Errors', [])}
+                for error in response.get('Errors', []):
+                    self.logger.warning(f"Failed to purge old backup file from S3, s3://{self.cfg.s3_bucket_name}/{error['Key']}, Error: {error.get('Message')}")
+                for file in batch:
+                    if file['Key'] not in failed_keys:
+                        self.logger.info(f"Successfully purged old backup file from S3, s3://{self.cfg.s3_bucket_name}/{file['Key']}")
+
+    def upload(self, filepath: str, digest: str = None) -> bool:
         upload_status = False
 
         # checking if file exists
@@ -148,12 +250,12 @@ class S3Handler(CloudStorageHandler):
             self.logger.warning(f'Cannot upload {filepath} to S3 as file {filepath} does not exists')
             return upload_status
 
-        self.logger.info(f'Trying to uploading {filepath} to S3, bucket: {S3_BUCKET_NAME}')
+        self.logger.info(f'Trying to uploading {filepath} to S3, bucket: {self.cfg.s3_bucket_name}')
         try:
             # Upload the backup file to S3
-            s3_backup_key = f"{S3_BACKUP_KEY_PREFIX}{os.path.basename(filepath)}"
-            self.s3_client.upload_file(filepath, S3_BUCKET_NAME, s3_backup_key)
-            self.logger.info(f'Successfully uploaded file to S3, s3://{S3_BUCKET_NAME}/{s3_backup_key}')
+            s3_backup_key = f"{self.cfg.s3_backup_key_prefix}{os.path.basename(filepath)}"
+            retry_with_backoff(lambda: self.__upload_file(filepath, s3_backup_key, digest), (S3UploadFailedError, BotoCoreError), self.logger, is_transient=self.__is_transient_error)
+            self.logger.info(f'Successfully uploaded file to S3, s3://{self.cfg.s3_bucket_name}/{s3_backup_key}')
             upload_status = True
         except Exception as e:
             self.logger.warning(f"Failed to upload file to S3, Error:{str(e)}")
@@ -161,109 +263,209 @@ class S3Handler(CloudStorageHandler):
         self.logger.info(f'Upload status: {upload_status}')
         return upload_status
 
+    @staticmethod
+    def __is_transient_error(error: Exception) -> bool:
+        # S3UploadFailedError is raised while handling the original ClientError
+        if isinstance(error, S3UploadFailedError) and error.__context__:
+            error = error.__context__
+
+        # only throttling and server errors are retried, other errors like AccessDenied or NoSuchBucket are permanent
+        if isinstance(error, ClientError):
+            error_code = error.response.get('Error', {}).get('Code')
+            status_code = error.response.get('ResponseMetadata', {}).get('HTTPStatusCode', 0)
+            return error_code in ('Throttling', 'ThrottlingException', 'SlowDown', 'RequestTimeout') or status_code == 429 or status_code >= 500
+
+        return isinstance(error, (BotoConnectionError, HTTPClientError))
+
+    def __upload_file(self, filepath: str, s3_backup_key: str, digest: str) -> None:
+        extra_args = dict(self._extra_args)
+        if digest:
+            extra_args['Metadata'] = {'sha256': digest}
+
+        with open(filepath, 'rb') as backup_file:
+            self.s3_client.upload_fileobj(backup_file, self.cfg.s3_bucket_name, s3_backup_key, ExtraArgs=extra_args, Config=self._tc)
+
 
 class GDriveHandler(CloudStorageHandler):
     """ Child class of CloudStorageHandler to handle Google drive (gDrive) operations
     """
 
-    def __init__(self) -> None:
+    # MIME types of the known backup file extensions
+    _MIME_TYPES = {
+        '.gz': 'application/gzip',
+        '.tar': 'application/x-tar',
+        '.zip': 'application/zip'
+    }
+
+    def __init__(self, cfg: Config) -> None:
         self.logger = LogHandler().get_logger(name=__class__.__name__)
+        self.cfg = cfg
+
+        # single authorized HTTP client with persistent connections, reused for all the requests including the upload chunks
+        # discovery cache is disabled as the file cache is unavailable with oauth2client>=4.0.0
+        creds = Credentials.from_service_account_file(self.cfg.google_credentials_file)
+        authorized_http = google_auth_httplib2.AuthorizedHttp(creds, http=httplib2.Http(timeout=60))
+        self.gdrive_service = build('drive', 'v3', http=authorized_http, cache_discovery=False)
 
-        creds = Credentials.from_service_account_file(GOOGLE_CREDENTIALS_FILE)
-        self.gdrive_service = build('drive', 'v3', credentials=creds)
+        # purge runs in a background thread, it gets its own HTTP client as httplib2.Http is not thread-safe
+        self.__purge_http = google_auth_httplib2.AuthorizedHttp(creds, http=httplib2.Http(timeout=60))
 
-    def upload(self, filepath: str) -> bool:
+    def upload(self, filepath: str, digest: str = None) -> bool:
         upload_status = False
-        if not os.path.exists(filepath):
-            self.logger.warning(f'Cannot upload {filepath} to google drive as file {filepath} does not exists')
-            return upload_status
 
         self.logger.info(f'Trying to uploading {filepath} to google drive')
         try:
             # Setting the name of file in google drive
             file_metadata = {
                 'name': os.path.basename(filepath),     # name of the target file on google drive
-                'parents': [GOOGLE_DRIVE_FOLDER_ID]     # name of the folder on google drive where the file needs to be uploaded
+                'parents': [self.cfg.google_drive_folder_id]     # name of the folder on google drive where the file needs to be uploaded
             }
+            if digest:
+                file_metadata['appProperties'] = {'sha256': digest}
 
-            # Trying to guess the MIME type of the file ; default is binary stream
-            mime_type, _ = mimetypes.guess_type(filepath)
-            if mime_type is None:
-                mime_type = 'application/octet-stream'
+            # MIME type of the file based on its extension ; default is binary stream
+            mime_type = self._MIME_TYPES.get(Path(filepath).suffix, 'application/octet-stream')
 
-            media = MediaFileUpload(filepath, mimetype=mime_type, resumable=True)
+            with open(filepath, 'rb') as backup_file:
+                # uploading in 64 MB chunks to reduce the number of HTTP round trips
+                media = MediaIoBaseUpload(backup_file, mimetype=mime_type, chunksize=64 * 1024 * 1024, resumable=True)
 
-            # Upload the file
-            request = self.gdrive_service.files().create(body=file_metadata, media_body=media, fields='id')
+                # Upload the file
+                request = self.gdrive_service.files().create(body=file_metadata, media_body=media, fields='id')
 
-            # Execute upload in chunks
-            response = None
-            while response is None:
-                status, response = request.next_chunk()
-                if status:
-                    self.logger.info(f"Uploaded {int(status.progress() * 100)}%.")
+                # Execute upload in chunks, failed uploads are resumed from the last uploaded chunk of the same upload session
+                response = retry_with_backoff(lambda: self.__upload_chunks(request), (HttpError, ConnectionError, TimeoutError), self.logger, is_transient=self.__is_transient_error)
 
             self.logger.info(f'Successfully uploaded file to google drive, file ID: {response.get("id")}')
             upload_status = True
+        except FileNotFoundError:
+            self.logger.warning(f'Cannot upload {filepath} to google drive as file {filepath} does not exists')
         except Exception as e:
             self.logger.warning(f"Failed to upload file to google drive, Error: {str(e)}")
 
         self.logger.info(f'Upload status: {upload_status}')
         return upload_status
 
-    def purge(self) -> None:
-        query = f"'{GOOGLE_DRIVE_FOLDER_ID}' in parents and trashed = false"
-        results = self.gdrive_service.files().list(q=query, spaces='drive', fields="files(id, name, createdTime)", orderBy="createdTime desc").execute()
+    @staticmethod
+    def __is_transient_error(error: Exception) -> bool:
+        # only rate limit and server errors are retried, other HTTP errors like 403 or 404 are permanent
+        if isinstance(error, HttpError):
+            return error.resp.status == 429 or error.resp.status >= 500
+        return True
+
+    def __upload_chunks(self, request: HttpRequest) -> dict:
+        # transient errors of each chunk are retried with exponential backoff
+        # progress is logged only in steps of 10%
+        response = None
+        last_step = -1
+        while response is None:
+            status, response = request.next_chunk(num_retries=5)
+            if status:
+                percentage = int(status.progress() * 100)
+                if percentage // 10 != last_step:
+                    self.logger.info(f"Uploaded {percentage}%.")
+                    last_step = percentage // 10
+
+        return response
+
+    def get_latest_digest(self) -> str:
+        # SHA-256 digest is stored as app property during upload
+        query = f"'{self.cfg.google_drive_folder_id}' in parents and trashed = false"
+        results = self.gdrive_service.files().list(q=query, spaces='drive', fields="files(appProperties)", orderBy="createdTime desc", pageSize=1).execute()
         existing_files = results.get('files', [])
+        if not existing_files:
+            return None
+
+        return existing_files[0].get('appProperties', {}).get('sha256')
+
+    def purge(self) -> None:
+        query = f"'{self.cfg.google_drive_folder_id}' in parents and trashed = false"
+
+        # files are sorted by the server, first page holds the files to keep ; further pages are only fetched when they exist, all of them are older files
+        page_size = min(self.cfg.max_backup_files + 50, 1000)
+        existing_files = []
+        page_token = None
+        while True:
+            results = self.gdrive_service.files().list(q=query, spaces='drive', fields="nextPageToken, files(id, name, createdTime)", orderBy="createdTime desc", pageSize=page_size, pageToken=page_token).execute(http=self.__purge_http)
+            existing_files.extend(results.get('files', []))
+            page_token = results.get('nextPageToken')
+            if not page_token:
+                break
+
+        if len(existing_files) > self.cfg.max_backup_files:
+            files_to_delete = existing_files[self.cfg.max_backup_files:]  # Keep the max_backup_files recent files
+
+            # deleting files using batch requests, a single batch request can hold at most 100 calls
+            for i in range(0, len(files_to_delete), 100):
+                batch = self.gdrive_service.new_batch_http_request()
+                for file in files_to_delete[i:i + 100]:
+                    batch.add(self.gdrive_service.files().delete(fileId=file['id']), callback=lambda request_id, response, exception, file=file: self.__on_file_deleted(file, exception))
+                batch.execute(http=self.__purge_http)
+
+    def __on_file_deleted(self, file: dict, exception: Exception) -> None:
+        if exception:
+            self.logger.warning(f"Failed to purge old backup file from google drive, file: {file['name']}, Error: {str(exception)}")
+            return
 
-        if len(existing_files) > MAX_BACKUP_FILES:
-            for file in existing_files[MAX_BACKUP_FILES:]:  # Keep the MAX_BACKUP_FILES recent files
-                self.gdrive_service.files().delete(fileId=file['id']).execute()
-                self.logger.info(f"Successfully purged old backup file from google drive, file: {file['name']}")
+        self.logger.info(f"Successfully purged old backup file from google drive, file: {file['name']}")
 
 
 class CpanelHandler():
     """ Class to interact with Cpanel
     """
 
-    def __init__(self) -> None:
+    def __init__(self, cfg: Config) -> None:
         self.logger = LogHandler().get_logger()
+        self.cfg = cfg
+
+        # backup file name pattern based on the format: backup-8.17.2024_17-46-55_{cpanel_username}.tar.gz
+        self.__backup_re = re.compile(rf"backup-\d{{1,2}}\.\d{{1,2}}\.\d{{4}}_\d{{2}}-\d{{2}}-\d{{2}}_{re.escape(cfg.cpanel_username)}\.tar\.gz")
+
+        # persistent HTTP session for the cPanel API, authenticated using the cPanel API Token
+        self.__http = requests.Session()
+        self.__http.headers['Authorization'] = f"cpanel {self.cfg.cpanel_username}:{self.cfg.cpanel_api_token}"
+
+        # # Authentication using the cPanel password
+        # self.__http.headers['Authorization'] = f"Bearer {self.cfg.cpanel_username}:{CPANEL_PASSWORD}"
 
-    def __get_backup_file(self) -> str:
-        # Determine the backup file name pattern based on the format: backup-8.17.2024_17-46-55_{cpanel_username}.tar.gz
-        regex_pattern = re.compile(rf"backup-\d{{1,2}}\.\d{{1,2}}\.\d{{4}}_\d{{2}}-\d{{2}}-\d{{2}}_{re.escape(CPANEL_USERNAME)}\.tar\.gz")
-        backup_directory = Path(f"/home/{CPANEL_USERNAME}/")
+        # only connection failures are retried ; POST is not retried on error responses as that could queue a duplicate backup
+        self.__http.mount('https://', HTTPAdapter(pool_connections=1, max_retries=Retry(total=3, backoff_factor=1)))
 
-        # Find the actual backup file
+    def __get_backup_file(self, run_started: float) -> os.DirEntry:
+        backup_directory = Path(f"/home/{self.cfg.cpanel_username}/")
+        backup_suffix = f'_{self.cfg.cpanel_username}.tar.gz'
+
+        # Find the actual backup file, cheap prefix/suffix check is done before the regex match
+        # stale backup files from previous runs are skipped based on their modification time
         self.logger.info(f'Looking for backup file under {backup_directory}')
-        backup_filename = next((f for f in backup_directory.iterdir() if regex_pattern.match(f.name)), None)
+        with os.scandir(backup_directory) as entries:
+            for entry in entries:
+                name = entry.name
+                if not name.startswith('backup-') or not name.endswith(backup_suffix):
+                    continue
+                if self.__backup_re.match(name) and entry.stat().st_mtime >= run_started:
+                    return entry
 
-        return backup_filename
+        return None
 
     def __initiate_full_backup(self) -> None:
         self.logger.info('Initializing full backup creation in cPanel')
 
-        # Create headers for authentication using the cPanel API Token
-        headers = {
-            "Authorization": f"cpanel {CPANEL_USERNAME}:{CPANEL_API_TOKEN}"
-        }
-
-        # # Create headers for authentication using the cPanel password
-        # headers = {
-        #     "Authorization": f"Bearer {CPANEL_USERNAME}:{CPANEL_PASSWORD}"
-        # }
-
         # Define the API endpoint for backup creation using UAPI
-        api_endpoint = f"{CPANEL_URL}/execute/Backup/fullbackup_to_homedir"
+        api_endpoint = f"{self.cfg.cpanel_url}/execute/Backup/fullbackup_to_homedir"
 
         # Set up the data payload for home directory backup
         payload = {
-            "email": BACKUP_DESTINATION_EMAIL,
+            "email": self.cfg.backup_destination_email,
             "homedir": "include"
         }
 
-        # Send the request to the cPanel API
-        response = requests.post(api_endpoint, headers=headers, data=payload)
+        # Send the request to the cPanel API, timeout is (connect, read) in seconds
+        try:
+            response = self.__http.post(api_endpoint, data=payload, timeout=(5, 30))
+        except requests.RequestException as e:
+            self.logger.error(f'Failed to create backup file via API, Error: {str(e)}')
+            return
 
         if response.status_code != 200:
             self.logger.error(f'Received unexpected response code while creating backup file via API, expected=200; received={response.status_code}')
@@ -277,53 +479,191 @@ class CpanelHandler():
 
         self.logger.info(f'Successfully initiated the full backup creation process')
 
-    def run_backup(self) -> str:
+    def run_backup(self) -> Path:
+        run_started = time.time()
         self.__initiate_full_backup()
 
-        self.logger.info(f'Waiting for {BACKUP_CHECK_DELAY} seconds for full backup creation process to complete')
-        time.sleep(BACKUP_CHECK_DELAY)
-
-        backup_filename = self.__get_backup_file()
-        if not backup_filename:
+        self.logger.info(f'Waiting upto {self.cfg.backup_check_delay} seconds for full backup creation process to complete')
+
+        # polling for the backup file with exponential backoff, file is considered complete when its size is unchanged between two polls
+        deadline = time.monotonic() + self.cfg.backup_check_delay
+        delay = 5
+        last_size = None
+        while time.monotonic() < deadline:
+            backup_entry = self.__get_backup_file(run_started)
+            if backup_entry:
+                current_size = backup_entry.stat().st_size
+                if current_size == last_size:
+                    self.logger.info(f'Backup file is {backup_entry.path}')
+                    return Path(backup_entry.path)
+                last_size = current_size
+
+            time.sleep(min(delay, max(deadline - time.monotonic(), 0)))
+            delay = min(delay * 1.5, 60)
+
+        # final check once the wait time is over, file must still be unchanged since the last poll
+        backup_entry = self.__get_backup_file(run_started)
+        if not backup_entry:
             self.logger.error(f'No backup file found, ensure that the backup process completed successfully')
             return
 
-        self.logger.info(f'Backup file is {backup_filename}')
-        return backup_filename
+        if backup_entry.stat().st_size != last_size:
+            self.logger.error(f'Backup file {backup_entry.path} is still being written, increase BACKUP_CHECK_DELAY to wait for the backup process to complete')
+            return
 
+        self.logger.info(f'Backup file is {backup_entry.path}')
+        return Path(backup_entry.path)
 
-# driver code
-if __name__ == '__main__':
+
+def upload_backup(handler: CloudStorageHandler, backup_filename: Path, digest: str) -> bool:
+    """ Uploads the backup file using the handler unless it is identical to the latest uploaded backup ; returns True when the backup is in the cloud storage
+    """
+    logger = LogHandler().get_logger()
+
+    # skipping upload when the backup is identical to the latest uploaded one
+    try:
+        latest_digest = handler.get_latest_digest()
+    except Exception as e:
+        latest_digest = None
+        logger.warning(f'Failed to get digest of the latest uploaded backup, Error: {str(e)}')
+
+    if digest == latest_digest:
+        logger.info(f'Backup file {backup_filename} is identical to the latest uploaded backup in {handler.__class__.__name__}, skipping upload')
+        return True
+
+    return handler.upload(backup_filename, digest)
+
+
+def mirror_backup(backup_filename: Path, mirror_directory: str) -> Path:
+    """ Copies the backup file to the mirror directory ; returns None when the copy fails as mirroring is optional
+    """
+    logger = LogHandler().get_logger()
+    mirror_filename = Path(mirror_directory) / backup_filename.name
+
+    # shutil.copyfile uses sendfile on linux and fcopyfile on macOS, so the data does not pass through python buffers
+    logger.info(f'Copying backup file {backup_filename} to {mirror_filename}')
+    try:
+        os.makedirs(mirror_directory, exist_ok=True)
+        shutil.copyfile(backup_filename, mirror_filename)
+    except shutil.SameFileError:
+        logger.warning(f'Skipping copy of backup file as mirror directory {mirror_directory} is the backup directory')
+        return None
+    except OSError as e:
+        logger.warning(f'Failed to copy backup file to mirror directory {mirror_directory}, Error: {str(e)}')
+
+        # removing the partially copied file
+        try:
+            mirror_filename.unlink(missing_ok=True)
+        except OSError:
+            pass
+        return None
+
+    return mirror_filename
+
+
+def upload_backups(handler_futures: list, backup_queue: queue.Queue, mirror_directory: str = None) -> None:
+    """ Consumer which uploads the backup files from the queue to all the cloud storages until a None is received
+    """
+    logger = LogHandler().get_logger()
+    handlers = [handler_future.result() for handler_future in handler_futures]
+
+    # backup is uploaded to all the cloud storages concurrently
+    # purging runs in background once the upload is complete, so that it overlaps with the cleanup and the next backup
+    purge_futures = []
+    with ThreadPoolExecutor(max_workers=len(handlers)) as upload_executor, ThreadPoolExecutor(max_workers=1) as purge_executor:
+        while True:
+            backup_filename = backup_queue.get()
+            if backup_filename is None:
+                break
+
+            # digest is computed once and shared by all the cloud storages
+            digest = compute_sha256(backup_filename)
+            upload_futures = {handler: upload_executor.submit(upload_backup, handler, backup_filename, digest) for handler in handlers}
+
+            upload_status = True
+            for handler, upload_future in upload_futures.items():
+                upload_status &= upload_future.result()
+                purge_futures.append(purge_executor.submit(handler.purge))
+
+            # mirroring in the upload worker so that it does not delay the next backup
+            if mirror_directory:
+                mirror_backup(backup_filename, mirror_directory)
+
+            # cleanup when upload is successful in all the cloud storages
+            if upload_status:
+                os.remove(backup_filename)
+                logger.info(f'Cleaned up backup file {backup_filename}')
+
+    for purge_future in purge_futures:
+        if purge_future.exception():
+            logger.warning(f'Failed to purge old backup files, Error: {str(purge_future.exception())}')
+
+
+def queue_backup(backup_queue: queue.Queue, backup_filename: Path, upload_future: Future) -> bool:
+    """ Puts the backup file in the queue, waiting while the queue is full ; returns False when the upload worker has already stopped
+    """
+    while not upload_future.done():
+        try:
+            backup_queue.put(backup_filename, timeout=1)
+            return True
+        except queue.Full:
+            pass
+
+    return False
+
+
+def main() -> None:
     # making sure that user selects proper target lcoation
     parser = argparse.ArgumentParser()
     required_group = parser.add_argument_group('required arguments')
-    required_group.add_argument('-t', '--target', choices=['gdrive', 's3'], help='cPanel backup target location', required=True, type=str)
+    required_group.add_argument('-t', '--target', choices=['gdrive', 's3', 'both'], help='cPanel backup target location', required=True, type=str)
+    parser.add_argument('-r', '--runs', help='number of backups to take, upload of a backup overlaps with creation of the next one', default=1, type=int)
+    parser.add_argument('-m', '--mirror', help='local directory to keep a copy of each backup file', type=str)
 
     args = parser.parse_args()
+    cfg = load_config()
 
     logger = LogHandler().get_logger()
     logger.info(f'Starting {APP_NAME} v{APP_VERSION}')
     logger.info(f'Target is {args.target}')
 
-    # taking full backup
-    cpanel_handler = CpanelHandler()
-    backup_filename = cpanel_handler.run_backup()
+    handler_classes = {
+        'gdrive': [GDriveHandler],
+        's3': [S3Handler],
+        'both': [S3Handler, GDriveHandler]
+    }[args.target]
 
-    upload_status = False
+    # at most one backup waits for upload while the next one is being created, so backups do not pile up in the home directory
+    backup_queue = queue.Queue(maxsize=1)
 
-    if args.target == 'gdrive':
-        gdrive = GDriveHandler()
-        upload_status = gdrive.upload(backup_filename)
-        gdrive.purge()
+    # workers initialize the cloud storage handlers while cPanel is creating the backup, one more worker uploads the created backups
+    with ThreadPoolExecutor(max_workers=len(handler_classes) + 1) as executor:
+        handler_futures = [executor.submit(handler_class, cfg) for handler_class in handler_classes]
+        upload_future = executor.submit(upload_backups, handler_futures, backup_queue, args.mirror)
 
-    elif args.target == 's3':
-        s3 = S3Handler()
-        upload_status = s3.upload(backup_filename)
-        s3.purge()
-
-    # cleanup when upload is successful
-    if upload_status:
-        os.remove(backup_filename)
-        logger.info(f'Cleaned up backup file {backup_filename}')
+        # taking full backups, each backup is queued for upload while the next one is being created
+        cpanel_handler = CpanelHandler(cfg)
+        try:
+            for _ in range(args.runs):
+                # no more backups are taken once the upload worker has stopped, its error is raised below
+                if upload_future.done():
+                    logger.error('Upload worker has stopped, skipping the remaining backups')
+                    break
+
+                backup_filename = cpanel_handler.run_backup()
+                if backup_filename:
+                    if not queue_backup(backup_queue, backup_filename, upload_future):
+                        logger.error('Upload worker has stopped, skipping the remaining backups')
+                        break
+        finally:
+            # always stopping the upload worker, otherwise the executor waits forever when backup creation fails
+            queue_backup(backup_queue, None, upload_future)
+
+        upload_future.result()
 
     logger.info('All done !')
+
+
+# driver code
+if __name__ == '__main__':
+    main()